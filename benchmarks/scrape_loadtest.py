@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_EXPORTER = os.path.join(ROOT, 'prometheus-exporters/cd-cli-exporter/ibmcd_cli_exporter.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def process_usage(pid):
+    """Returns (CPU seconds, RSS bytes) of pid from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        # Fields after the command name, which may contain spaces
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    with open(f'/proc/{pid}/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    return cpu_seconds, rss_kb * 1024
+
+def wait_ready(base_url, timeout):
+    """Waits until /ready answers 200, i.e. the exporter has published its first collection"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'{base_url}/ready', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise Exception(f"Exporter at {base_url} not ready after {timeout}s")
+
+def scraper(url, period, stop_at, results, lock):
+    """Scrapes url every period seconds until stop_at, appending (latency seconds, bytes) or None on errors"""
+    next_at = time.perf_counter()
+    local = []
+    while next_at < stop_at:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                size = len(response.read())
+            local.append((time.perf_counter() - started, size))
+        except OSError:
+            local.append(None)
+        next_at += period
+    with lock:
+        results.extend(local)
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def run_load(url, pid, concurrency, rate, duration):
+    """Runs concurrency scrapers at rate total scrapes per second for duration seconds, returns the report"""
+    results = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+    period = concurrency / rate
+
+    cpu_before, rss_max = process_usage(pid) if pid else (0.0, 0)
+    threads = [threading.Thread(target=scraper, args=(url, period, stop_at, results, lock), daemon=True)
+               for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+        if pid:
+            rss_max = max(rss_max, process_usage(pid)[1])
+    elapsed = time.perf_counter() - started
+    cpu_after = process_usage(pid)[0] if pid else 0.0
+
+    ok = [r for r in results if r is not None]
+    latencies = [latency for latency, _ in ok]
+    return {
+        'scrapes': len(results),
+        'errors': len(results) - len(ok),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if ok else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if ok else None,
+        'max_ms': round(max(latencies) * 1000, 2) if ok else None,
+        'bytes_served': sum(size for _, size in ok),
+        'bytes_per_scrape': round(sum(size for _, size in ok) / len(ok)) if ok else 0,
+        'exporter_cpu_percent': round((cpu_after - cpu_before) / elapsed * 100, 1) if pid else None,
+        'exporter_rss_max_mb': round(rss_max / 1024 / 1024, 1) if pid else None,
+    }
+
+def main():
+    """Load tests /metrics of an exporter, started here with a synthetic TCQ unless --url is given"""
+    parser = argparse.ArgumentParser(description="IBM Connect:Direct exporters scrape load test")
+    parser.add_argument('--url', help='Base URL of a running exporter, for example http://localhost:9400. By default a CLI exporter is started with --synthetic')
+    parser.add_argument('--pid', type=int, help='PID of the exporter given with --url, to report its CPU and RSS')
+    parser.add_argument('--port', type=int, default=9499, help='Port of the exporter started by the load test')
+    parser.add_argument('--processes', type=int, default=2000, help='Processes in the synthetic TCQ of the started exporter')
+    parser.add_argument('--interval', type=int, default=5, help='Collection interval of the started exporter, in seconds')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent scrapers')
+    parser.add_argument('--rate', type=float, default=20, help='Total scrapes per second')
+    parser.add_argument('--duration', type=int, default=30, help='Test duration in seconds')
+    parser.add_argument('--save', metavar='FILE', help='Save the report as JSON, to use as a --baseline later')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the report with a report saved by --save')
+    args = parser.parse_args()
+
+    exporter = None
+    base_url = args.url
+    pid = args.pid
+    if base_url is None:
+        exporter = subprocess.Popen([sys.executable, CLI_EXPORTER, '--synthetic', str(args.processes),
+                                     '--interval', str(args.interval), '--port', str(args.port)],
+                                    stdout=subprocess.DEVNULL)
+        base_url = f'http://127.0.0.1:{args.port}'
+        pid = exporter.pid
+
+    try:
+        wait_ready(base_url, timeout=60)
+        print(f"[INFO] Scraping {base_url}/metrics with {args.concurrency} scrapers at {args.rate}/s for {args.duration}s")
+        report = run_load(f'{base_url}/metrics', pid, args.concurrency, args.rate, args.duration)
+    finally:
+        if exporter is not None:
+            exporter.terminate()
+            exporter.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    for key, value in report.items():
+        line = f"{key:<22} {value}"
+        if baseline and isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)):
+            line += f"  (baseline {baseline[key]}, {value - baseline[key]:+g})"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
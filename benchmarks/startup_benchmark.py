@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import subprocess
+import sys
+import time
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Exporter script, import time budget in milliseconds and modules that must not be loaded at startup
+EXPORTERS = [
+    ('prometheus-exporters/cd-cli-exporter/ibmcd_cli_exporter.py', 150, ['asyncio', 'requests', 'opentelemetry']),
+    ('prometheus-exporters/cd-restapi-exporter/ibmcd_restapi_exporter.py', 200, ['asyncio', 'requests', 'urllib3', 'opentelemetry']),
+    ('prometheus-exporters/cd-multisource-exporter/ibmcd_multisource_exporter.py', 200, ['asyncio', 'requests', 'urllib3', 'opentelemetry']),
+    ('otel-exporters/cd-cli-metrics-exporter/ibmcd_cli_otel_exporter.py', 50, ['opentelemetry', 'prometheus_client', 'requests']),
+    ('otel-exporters/cd-restapi-metrics-exporter/ibmcd_restapi_otel_exporter.py', 50, ['opentelemetry', 'prometheus_client', 'requests', 'urllib3']),
+]
+
+# "import time: self [us] | cumulative | imported package", nested imports are indented
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+def measure(script):
+    """Runs the script with --help under -X importtime, returns (import ms, wall ms, loaded modules)"""
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(ROOT, script), '--help'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise Exception(f"{script} --help returned code {result.returncode}: {result.stderr[-500:]}")
+
+    import_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            modules.add(match.group(4))
+            # Top level imports only, their cumulative time includes the nested ones
+            if len(match.group(3)) == 1:
+                import_us += int(match.group(2))
+    return import_us / 1000, wall_ms, modules
+
+def main():
+    """Measures the startup cost of each exporter and checks it against its import time budget"""
+    parser = argparse.ArgumentParser(description="IBM Connect:Direct exporters startup benchmark")
+    parser.add_argument('--runs', type=int, default=5, help='Runs per exporter, the median is reported')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='Multiplies every budget, for slower machines')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'exporter':<75} {'import ms':>10} {'wall ms':>10} {'budget ms':>10}")
+    for script, budget_ms, forbidden in EXPORTERS:
+        runs = [measure(script) for _ in range(args.runs)]
+        import_ms = statistics.median(r[0] for r in runs)
+        wall_ms = statistics.median(r[1] for r in runs)
+        budget_ms *= args.budget_scale
+        loaded = sorted(m for m in runs[0][2] if m.split('.')[0] in forbidden)
+
+        status = 'OK'
+        if import_ms > budget_ms:
+            status = 'OVER BUDGET'
+        if loaded:
+            status = f"LOADS {', '.join(loaded[:3])}"
+        failed = failed or status != 'OK'
+        print(f"{script:<75} {import_ms:>10.1f} {wall_ms:>10.1f} {budget_ms:>10.0f}  {status}")
+
+    exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -4,22 +4,9 @@ import os
 import subprocess
 import time
 import argparse
-from opentelemetry import metrics
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.prometheus import PrometheusMetricReader
-from prometheus_client import start_http_server
 
 DEBUG = True
 
-# Configure OpenTelemetry with Prometheus exporter
-prometheus_reader = PrometheusMetricReader()
-provider = MeterProvider(metric_readers=[prometheus_reader])
-metrics.set_meter_provider(provider)
-
-# Create a meter
-meter = metrics.get_meter(__name__)
-
 # Global variables to store metric values
 metric_values = {
     'hold': 0,
@@ -28,73 +15,117 @@ metric_values = {
     'exec': 0
 }
 
-# Observable gauge callbacks
-def hold_callback(options):
-    yield metrics.Observation(metric_values['hold'])
-
-def wait_callback(options):
-    yield metrics.Observation(metric_values['wait'])
-
-def timer_callback(options):
-    yield metrics.Observation(metric_values['timer'])
-
-def exec_callback(options):
-    yield metrics.Observation(metric_values['exec'])
-
-# Register callbacks for observable gauges
-ibm_cd_hold_total = meter.create_observable_gauge(
-    name='ibm_cd_processes_hold_total',
-    callbacks=[hold_callback],
-    description='Total processes in HOLD state',
-    unit='1'
-)
-
-ibm_cd_wait_total = meter.create_observable_gauge(
-    name='ibm_cd_processes_wait_total',
-    callbacks=[wait_callback],
-    description='Total processes in WAIT state',
-    unit='1'
-)
-
-ibm_cd_timer_total = meter.create_observable_gauge(
-    name='ibm_cd_processes_timer_total',
-    callbacks=[timer_callback],
-    description='Total processes in TIMER state',
-    unit='1'
-)
-
-ibm_cd_exec_total = meter.create_observable_gauge(
-    name='ibm_cd_processes_exec_total',
-    callbacks=[exec_callback],
-    description='Total processes in EXEC state',
-    unit='1'
-)
-
-ibm_cd_scrape_errors = meter.create_counter(
-    name='ibm_cd_scrape_errors_total',
-    description='Total errors when collecting IBM Connect:Direct metrics',
-    unit='1'
-)
+# Created by setup_opentelemetry(), --textfile runs never load OpenTelemetry
+ibm_cd_scrape_errors = None
+
+def setup_opentelemetry():
+    """Configures OpenTelemetry with the Prometheus exporter and registers the metrics"""
+    global ibm_cd_scrape_errors
+
+    from opentelemetry import metrics
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.exporter.prometheus import PrometheusMetricReader
+
+    # Configure OpenTelemetry with Prometheus exporter
+    prometheus_reader = PrometheusMetricReader()
+    provider = MeterProvider(metric_readers=[prometheus_reader])
+    metrics.set_meter_provider(provider)
+
+    # Create a meter
+    meter = metrics.get_meter(__name__)
+
+    # Observable gauge callbacks
+    def observe(key):
+        def callback(options):
+            yield metrics.Observation(metric_values[key])
+        return callback
+
+    # Register callbacks for observable gauges
+    for key, state in (('hold', 'HOLD'), ('wait', 'WAIT'), ('timer', 'TIMER'), ('exec', 'EXEC')):
+        meter.create_observable_gauge(
+            name=f'ibm_cd_processes_{key}_total',
+            callbacks=[observe(key)],
+            description=f'Total processes in {state} state',
+            unit='1'
+        )
 
+    ibm_cd_scrape_errors = meter.create_counter(
+        name='ibm_cd_scrape_errors_total',
+        description='Total errors when collecting IBM Connect:Direct metrics',
+        unit='1'
+    )
+
+def write_textfile(path, success):
+    """Writes the current metric values in the Prometheus text format, without loading OpenTelemetry.
+
+    A failed collection only writes ibm_cd_scrape_errors_total, so no zeroed queue gauges are served as data.
+    """
+    lines = []
+    if success:
+        for key in ('hold', 'wait', 'timer', 'exec'):
+            name = f'ibm_cd_processes_{key}_total'
+            lines.append(f'# HELP {name} Total processes in {key.upper()} state\n')
+            lines.append(f'# TYPE {name} gauge\n')
+            lines.append(f'{name} {metric_values[key]}\n')
+    lines.append('# HELP ibm_cd_scrape_errors_total Total errors when collecting IBM Connect:Direct metrics\n')
+    lines.append('# TYPE ibm_cd_scrape_errors_total counter\n')
+    lines.append(f'ibm_cd_scrape_errors_total {0 if success else 1}\n')
+
+    with open(f'{path}.tmp', 'w') as f:
+        f.writelines(lines)
+    os.replace(f'{path}.tmp', path)
+
+
+# Subprocess environment of each node, keyed by base path and built once
+node_environments = {}
+
+def node_environment(base_path):
+    """Returns the environment for the direct CLI of base_path, without touching os.environ"""
+    env = node_environments.get(base_path)
+    if env is None:
+        env = dict(os.environ)
+        env['NDMAPICFG'] = f'{base_path}/cdunix/ndm/cfg/cliapi/ndmapi.cfg'
+
+        # Ensure library paths are set (helps with missing libtirpc.so.1 and other shared libraries)
+        lib_path = f'{base_path}/cdunix/ndm/lib'
+        if os.path.isdir(lib_path):
+            current_ld_path = env.get('LD_LIBRARY_PATH', '')
+            env['LD_LIBRARY_PATH'] = f"{lib_path}:{current_ld_path}" if current_ld_path else lib_path
+
+        node_environments[base_path] = env
+    return env
+
+def check_node(base_path):
+    """Checks once that the direct binary of base_path can run, returns the list of problems found"""
+    problems = []
+    binary = f'{base_path}/cdunix/ndm/bin/direct'
+    env = node_environment(base_path)
+
+    if not os.access(binary, os.X_OK):
+        return [f"Binary not found or not executable at {binary}"]
+    if not os.path.isfile(env['NDMAPICFG']):
+        problems.append(f"CLI configuration not found at {env['NDMAPICFG']}")
+
+    # ldd resolves the shared libraries (libtirpc.so.1, ...) with the same LD_LIBRARY_PATH as run_cmd
+    try:
+        ldd = subprocess.run(['ldd', binary], env=env, capture_output=True, text=True, timeout=30)
+        for line in ldd.stdout.splitlines():
+            if 'not found' in line:
+                problems.append(f"Shared library not resolvable: {line.split('=>')[0].strip()}")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"[WARN] Could not check the shared libraries of {binary}: {e}")
 
+    return problems
 
 def run_cmd(base_path):
     """Executes the selpro command and returns the output"""
-    # Defines the environment variable
-    os.environ['NDMAPICFG'] = f'{base_path}/cdunix/ndm/cfg/cliapi/ndmapi.cfg'
-    
-    # Ensure library paths are set (helps with missing libtirpc.so.1 and other shared libraries)
-    lib_path = f'{base_path}/cdunix/ndm/lib'
-    if os.path.isdir(lib_path):
-        current_ld_path = os.environ.get('LD_LIBRARY_PATH', '')
-        os.environ['LD_LIBRARY_PATH'] = f"{lib_path}:{current_ld_path}" if current_ld_path else lib_path
-
     try:
         process = subprocess.Popen(
             [f'{base_path}/cdunix/ndm/bin/direct', '-s'],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            env=node_environment(base_path),
             text=True
         )
         
@@ -146,10 +177,14 @@ def collect_metrics(base_path):
         count_exec = selpro_output.count('EXEC')
         metric_values['exec'] = count_exec
         print(f"[INFO] Processes in EXEC: {count_exec}")
+
+        return True
             
     except Exception as e:
         print(f"[ERROR] Failed to collect metrics: {e}")
-        ibm_cd_scrape_errors.add(1)
+        if ibm_cd_scrape_errors is not None:
+            ibm_cd_scrape_errors.add(1)
+        return False
 
 
 def main():
@@ -163,6 +198,7 @@ def main():
     # action='store_true' means that if the argument is present, the value will be True, otherwise False.
     # can be used --debug or --debug=True
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
+    parser.add_argument('--textfile', metavar='PATH', help='Collect once, write the metrics to PATH (node_exporter textfile collector format) and exit, without loading OpenTelemetry')
 
     args = parser.parse_args()
 
@@ -178,8 +214,22 @@ def main():
     if not base_path:
         print("[ERROR] Base path is required")
         exit(1)
+
+    problems = check_node(base_path)
+    for problem in problems:
+        print(f"[ERROR] {problem}")
+    if problems:
+        exit(1)
     
+    if args.textfile:
+        success = collect_metrics(base_path)
+        write_textfile(args.textfile, success)
+        exit(0 if success else 1)
+
+    setup_opentelemetry()
+
     # Start the Prometheus HTTP server for metrics exposition
+    from prometheus_client import start_http_server
     start_http_server(port)
     
     # Infinite loop to collect metrics
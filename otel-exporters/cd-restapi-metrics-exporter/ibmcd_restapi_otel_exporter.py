@@ -3,18 +3,8 @@
 import base64
 import time
 import argparse
-from opentelemetry import metrics
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.prometheus import PrometheusMetricReader
-from prometheus_client import start_http_server
-import requests
-from requests.exceptions import ConnectTimeout, ReadTimeout
-import urllib3
 import json
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 DEBUG=False
 INTERVAL=60
 LOCALPORT=9402
@@ -22,44 +12,60 @@ LOCALPORT=9402
 # Global variable to hold signon data
 signon_data = None
 
-# Setup OpenTelemetry
-reader = PrometheusMetricReader()
-provider = MeterProvider(metric_readers=[reader])
-metrics.set_meter_provider(provider)
-
-# Create a meter
-meter = metrics.get_meter(__name__)
-
-# Create metrics
-ibm_cd_hold_total = meter.create_up_down_counter(
-    name='ibm_cd_processes_hold_total',
-    description='Total processes in HOLD state',
-    unit='1'
-)
-
-ibm_cd_wait_total = meter.create_up_down_counter(
-    name='ibm_cd_processes_wait_total',
-    description='Total processes in WAIT state',
-    unit='1'
-)
-
-ibm_cd_timer_total = meter.create_up_down_counter(
-    name='ibm_cd_processes_timer_total',
-    description='Total processes in TIMER state',
-    unit='1'
-)
-
-ibm_cd_exec_total = meter.create_up_down_counter(
-    name='ibm_cd_processes_exec_total',
-    description='Total processes in EXEC state',
-    unit='1'
-)
-
-ibm_cd_scrape_errors = meter.create_counter(
-    name='ibm_cd_scrape_errors_total',
-    description='Total errors when collecting IBM Connect:Direct metrics',
-    unit='1'
-)
+# Created by setup_opentelemetry() once the arguments are parsed
+ibm_cd_hold_total = None
+ibm_cd_wait_total = None
+ibm_cd_timer_total = None
+ibm_cd_exec_total = None
+ibm_cd_scrape_errors = None
+
+
+def setup_opentelemetry():
+    """Configures OpenTelemetry with the Prometheus exporter and creates the metrics"""
+    global ibm_cd_hold_total, ibm_cd_wait_total, ibm_cd_timer_total, ibm_cd_exec_total, ibm_cd_scrape_errors
+
+    from opentelemetry import metrics
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.exporter.prometheus import PrometheusMetricReader
+
+    # Setup OpenTelemetry
+    reader = PrometheusMetricReader()
+    provider = MeterProvider(metric_readers=[reader])
+    metrics.set_meter_provider(provider)
+
+    # Create a meter
+    meter = metrics.get_meter(__name__)
+
+    # Create metrics
+    ibm_cd_hold_total = meter.create_up_down_counter(
+        name='ibm_cd_processes_hold_total',
+        description='Total processes in HOLD state',
+        unit='1'
+    )
+
+    ibm_cd_wait_total = meter.create_up_down_counter(
+        name='ibm_cd_processes_wait_total',
+        description='Total processes in WAIT state',
+        unit='1'
+    )
+
+    ibm_cd_timer_total = meter.create_up_down_counter(
+        name='ibm_cd_processes_timer_total',
+        description='Total processes in TIMER state',
+        unit='1'
+    )
+
+    ibm_cd_exec_total = meter.create_up_down_counter(
+        name='ibm_cd_processes_exec_total',
+        description='Total processes in EXEC state',
+        unit='1'
+    )
+
+    ibm_cd_scrape_errors = meter.create_counter(
+        name='ibm_cd_scrape_errors_total',
+        description='Total errors when collecting IBM Connect:Direct metrics',
+        unit='1'
+    )
 
 # Store current values for counters
 current_values = {
@@ -71,6 +77,9 @@ current_values = {
 
 
 def signon(cdws_config):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
+
     url = f'{cdws_config["cdws_server"]}/cdwebconsole/svc/signon'
 
     # Encode the credentials (username:password) in Base64 format.
@@ -113,6 +122,9 @@ def signon(cdws_config):
 
 
 def signout(cdws_config, signon_data):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
+
     url = f'{cdws_config["cdws_server"]}/cdwebconsole/svc/signout'
     headers = {
         "Accept": "application/json", "Content-Type": "application/json; charset=utf-8",
@@ -137,6 +149,9 @@ def signout(cdws_config, signon_data):
 
 
 def tcq_metrics(cdws_config, signon_data):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
+
     headers = {
         "Accept": "application/json", "Content-Type": "application/json; charset=utf-8",
         "X-XSRF-TOKEN": signon_data["_csrf"], "Authorization": signon_data["authorization"], "Cookie": signon_data["set-cookie"]
@@ -260,12 +275,18 @@ def main():
     print(f"[INFO] C:D port: {cdws_config['cd_port']}")
     print(f"[INFO] C:D protocol: {cdws_config['cd_protocol']}")
 
+    # OpenTelemetry, requests and urllib3 are only loaded once the arguments are valid
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    setup_opentelemetry()
+
     signon_data = signon(cdws_config)
     if signon_data is None:
         raise Exception("Initial signon failed")
     
     # Starts the Prometheus HTTP server
     print(f"[INFO] Starting Prometheus HTTP server on port {port}")
+    from prometheus_client import start_http_server
     start_http_server(port)
 
     # Infinite loop to collect metrics
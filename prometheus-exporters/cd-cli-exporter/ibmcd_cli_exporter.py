@@ -1,13 +1,38 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import logging
 import subprocess
+import sys
 import time
 import argparse
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import write_to_textfile, Gauge, Counter
 from prometheus_client.core import CollectorRegistry
 
-DEBUG=True
+# Code shared by the Prometheus exporters, in the common directory next to this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import ibmcd_exporter_common as common
+
+DEBUG=False
+MAX_SNODES=50
+HISTORY_SIZE=720
+RECORD_DIR=None
+LOG_RATE_LIMIT=60
+HOTSPOT_TOP_K=10
+HOTSPOT_HALF_LIFE=3600
+
+# Queries the CLI source can batch in one direct session: name -> (command, title of its output banner)
+CLI_QUERIES = {
+    'selpro': ('selpro detail=yes;', 'SELECT PROCESS'),
+    'selstat': ('select statistics detail=yes startt=(today);', 'SELECT STATISTICS'),
+    'netmap': ('select netmap name=*;', 'SELECT NETMAP'),
+}
+QUERY_NAMES=('selpro',)
+
+# Label used for remote nodes beyond MAX_SNODES, keeps cardinality bounded
+OTHER_SNODE = '__other__'
+QUEUES = ('HOLD', 'WAIT', 'TIMER', 'EXEC')
 
 # Creates the registry
 registry = CollectorRegistry()
@@ -44,33 +69,104 @@ ibm_cd_process_count = Gauge(
     registry=registry
 )
 
+ibm_cd_processes_by_snode = Gauge(
+    'ibm_cd_processes_by_snode',
+    'Total processes per TCQ queue and remote node (SNODE)',
+    ['queue', 'snode'],
+    registry=registry
+)
+
+ibm_cd_cli_query_records = Gauge(
+    'ibm_cd_cli_query_records',
+    'Records parsed from each CLI query of the last batch',
+    ['query'],
+    registry=registry
+)
+
+ibm_cd_cli_query_errors = Counter(
+    'ibm_cd_cli_query_errors',
+    'CLI queries of a batch that printed an error instead of their output',
+    ['query'],
+    registry=registry
+)
+
+ibm_cd_process_hotspot = Gauge(
+    'ibm_cd_process_hotspot',
+    'Worst offending process names by kind: retries, held_error (entries in HOLD due to error) and timer_seconds, decaying over time',
+    ['kind', 'process_name'],
+    registry=registry
+)
+
 ibm_cd_scrape_errors = Counter(
     'ibm_cd_scrape_errors_total',
     'Total errors when collecting IBM Connect:Direct metrics',
     registry=registry
 )
 
-def run_cmd(base_path):
-    """Executes the selpro command and returns the output"""
-    # Defines the environment variable
-    os.environ['NDMAPICFG'] = f'{base_path}/cdunix/ndm/cfg/cliapi/ndmapi.cfg'
-    
-    # Ensure library paths are set (helps with missing libtirpc.so.1 and other shared libraries)
-    lib_path = f'{base_path}/cdunix/ndm/lib'
-    if os.path.isdir(lib_path):
-        current_ld_path = os.environ.get('LD_LIBRARY_PATH', '')
-        os.environ['LD_LIBRARY_PATH'] = f"{lib_path}:{current_ld_path}" if current_ld_path else lib_path
+logger = common.logger
 
+# Serves the registry on /metrics and keeps the /history ring buffers
+server = common.MetricsServer(registry, HISTORY_SIZE)
+
+# Subprocess environment of each node, keyed by base path and built once
+node_environments = {}
+
+def node_environment(base_path):
+    """Returns the environment for the direct CLI of base_path, without touching os.environ"""
+    env = node_environments.get(base_path)
+    if env is None:
+        env = dict(os.environ)
+        env['NDMAPICFG'] = f'{base_path}/cdunix/ndm/cfg/cliapi/ndmapi.cfg'
+
+        # Ensure library paths are set (helps with missing libtirpc.so.1 and other shared libraries)
+        lib_path = f'{base_path}/cdunix/ndm/lib'
+        if os.path.isdir(lib_path):
+            current_ld_path = env.get('LD_LIBRARY_PATH', '')
+            env['LD_LIBRARY_PATH'] = f"{lib_path}:{current_ld_path}" if current_ld_path else lib_path
+
+        node_environments[base_path] = env
+    return env
+
+def check_node(base_path):
+    """Checks once that the direct binary of base_path can run, returns the list of problems found"""
+    problems = []
+    binary = f'{base_path}/cdunix/ndm/bin/direct'
+    env = node_environment(base_path)
+
+    if not os.access(binary, os.X_OK):
+        return [f"Binary not found or not executable at {binary}"]
+    if not os.path.isfile(env['NDMAPICFG']):
+        problems.append(f"CLI configuration not found at {env['NDMAPICFG']}")
+
+    # ldd resolves the shared libraries (libtirpc.so.1, ...) with the same LD_LIBRARY_PATH as run_cmd
+    try:
+        ldd = subprocess.run(['ldd', binary], env=env, capture_output=True, text=True, timeout=30)
+        for line in ldd.stdout.splitlines():
+            if 'not found' in line:
+                problems.append(f"Shared library not resolvable: {line.split('=>')[0].strip()}")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning('Could not check the shared libraries of %s: %s', binary, e)
+
+    return problems
+
+def run_cmd(base_path, queries=('selpro',), timeout=None):
+    """Executes the queries in a single direct session and returns the combined output.
+
+    A session still running after timeout seconds (None waits forever) is killed.
+    """
     try:
         process = subprocess.Popen(
             [f'{base_path}/cdunix/ndm/bin/direct', '-s'],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            env=node_environment(base_path),
             text=True
         )
         
-        selpro_output, stderr = process.communicate(input='selpro;\n')
+        # One stdin batch, so the whole cycle costs a single fork and sign-on
+        batch = ''.join(f'{CLI_QUERIES[query][0]}\n' for query in queries)
+        selpro_output, stderr = process.communicate(input=batch, timeout=timeout)
         
         if process.returncode == 127:
             raise Exception(f"Command not found or cannot execute binary (exit code 127). Check if libtirpc.so.1 is installed: {stderr}")
@@ -85,70 +181,305 @@ def run_cmd(base_path):
         raise Exception(f"OS Error executing command (missing library?): {e}")
     except subprocess.TimeoutExpired:
         process.kill()
-        raise Exception("Timeout executing command")
+        process.communicate()
+        raise Exception(f"Timeout executing command after {timeout}s")
     except Exception as e:
         raise Exception(f"Error executing command: {e}")
 
-def collect_metrics(base_path):
-    """Collects IBM Connect:Direct metrics and updates Prometheus metrics"""
+# Matches "Key => Value" pairs, selpro detail=yes prints up to two per line
+FIELD_RE = re.compile(r'([A-Za-z][A-Za-z ]*?)\s*=>\s*(.*?)(?=\s{2,}[A-Za-z][A-Za-z ]*?\s*=>|$)')
+
+# Error lines the CLI prints instead of a command output, e.g. "XSQL010E ..." (E = error severity)
+CLI_ERROR_RE = re.compile(r'^\s*(?:[A-Z]{4}\d{3}E\b|ERROR\b|Error\b)')
+
+def split_output(output, queries):
+    """Demultiplexes the combined output of a batch into ({query: output section}, {query: error lines}).
+
+    Sections start at the banner of each query. A failed command prints error lines instead of its banner,
+    so the error lines seen before a banner belong to the first query that banner skipped over. Error lines
+    inside a section, with no query skipped, belong to that section's query.
+    """
+    if len(queries) == 1:
+        errors = [line.strip() for line in output.splitlines() if CLI_ERROR_RE.match(line)]
+        return {queries[0]: output}, ({queries[0]: errors} if errors else {})
+
+    titles = {CLI_QUERIES[query][1]: index for index, query in enumerate(queries)}
+    sections = {query: [] for query in queries}
+    errors = {}
+    pending = []
+    current = -1
+
+    def settle(next_index):
+        # The queries between the current banner and next_index never printed their banner
+        skipped = queries[current + 1:next_index]
+        for position, query in enumerate(skipped):
+            errors[query] = (pending if position == 0 and pending else ['no output']).copy()
+        if pending and not skipped:
+            errors.setdefault(queries[max(current, 0)], []).extend(pending)
+        pending.clear()
+
+    for line in output.splitlines(keepends=True):
+        index = titles.get(line.strip().upper())
+        if index is not None:
+            if index > current:
+                settle(index)
+            current = index
+        elif CLI_ERROR_RE.match(line):
+            pending.append(line.strip())
+            continue
+        if current >= 0:
+            sections[queries[current]].append(line)
+    settle(len(queries))
+
+    return {query: ''.join(lines) for query, lines in sections.items()}, errors
+
+def parse_batch(output, queries):
+    """Parses the combined output of a batch into ({query: list of records}, {query: error lines}).
+
+    Failed queries are left out of the records rather than reported as empty.
+    """
+    sections, errors = split_output(output, queries)
+    records = {query: parse_selpro(text) if query == 'selpro' else parse_records(text)
+               for query, text in sections.items() if query not in errors}
+    return records, errors
+
+def parse_records(output):
+    """Parses "Key => Value" command output into a list of records (dicts)"""
+    records = []
+    record = {}
+    for line in output.splitlines():
+        for key, value in FIELD_RE.findall(line):
+            key = key.strip().lower()
+            # A repeated key means the next process record has started
+            if key in record:
+                records.append(record)
+                record = {}
+            record[key] = value.strip()
+    if record:
+        records.append(record)
+    return records
+
+def parse_selpro(selpro_output):
+    """Parses the selpro detail=yes output into a list of TCQ records (dicts)"""
+    return [r for r in parse_records(selpro_output) if 'queue' in r]
+
+def aggregate_by_snode(records, max_snodes=MAX_SNODES):
+    """Aggregates TCQ records in one pass into queue totals and a {(queue, snode): count} table.
+
+    Remote nodes beyond max_snodes (by number of processes) are folded into OTHER_SNODE.
+    """
+    queue_totals = dict.fromkeys(QUEUES, 0)
+    by_snode = {}
+    snode_totals = {}
+    for record in records:
+        queue = record.get('queue', '').upper()
+        if queue not in queue_totals:
+            continue
+        snode = (record.get('snode') or record.get('other node') or '').upper() or 'UNKNOWN'
+        queue_totals[queue] += 1
+        by_snode[(queue, snode)] = by_snode.get((queue, snode), 0) + 1
+        snode_totals[snode] = snode_totals.get(snode, 0) + 1
+
+    if len(snode_totals) > max_snodes:
+        kept = set(sorted(snode_totals, key=snode_totals.get, reverse=True)[:max_snodes])
+        folded = {}
+        for (queue, snode), count in by_snode.items():
+            key = (queue, snode if snode in kept else OTHER_SNODE)
+            folded[key] = folded.get(key, 0) + count
+        by_snode = folded
+
+    return queue_totals, by_snode
+
+# Last written state of each gauge, unlabeled gauges use the () label set
+queue_snapshots = {
+    'HOLD': common.GaugeSnapshot(ibm_cd_hold_total),
+    'WAIT': common.GaugeSnapshot(ibm_cd_wait_total),
+    'TIMER': common.GaugeSnapshot(ibm_cd_timer_total),
+    'EXEC': common.GaugeSnapshot(ibm_cd_exec_total)
+}
+snode_snapshot = common.GaugeSnapshot(ibm_cd_processes_by_snode)
+
+# Created in main() once the hot-spot arguments are parsed
+hotspots = None
+hotspot_snapshot = common.GaugeSnapshot(ibm_cd_process_hotspot)
+query_snapshot = common.GaugeSnapshot(ibm_cd_cli_query_records)
+
+def synthetic_output(processes, seed):
+    """Builds a selpro detail=yes output with the given number of processes, the stand-in source for load tests"""
+    import random
+
+    rng = random.Random(seed)
+    lines = ['=' * 80, 'SELECT PROCESS'.center(80), '=' * 80]
+    for number in range(1, processes + 1):
+        queue = rng.choice(QUEUES)
+        status = 'WS'
+        if rng.random() < 0.3:
+            status = {'HOLD': 'HE', 'TIMER': 'RE'}.get(queue, status)
+        lines.append(f'Process Name   => SYN{rng.randrange(1000):04d}        Class     => 1')
+        lines.append(f'Process Number => {number}')
+        lines.append(f'Snode          => SYNNODE{rng.randrange(200):03d}')
+        lines.append(f'Queue          => {queue:<14} Status    => {status}')
+        lines.append('-' * 80)
+    return '\n'.join(lines) + '\n'
+
+def collect_metrics(base_path, node, recording=None):
+    """Collects IBM Connect:Direct metrics and updates Prometheus metrics.
+
+    recording is an optional (timestamp, batch output) pair used instead of running the queries.
+    """
     try:
-        selpro_output = run_cmd(base_path)
+        if recording is None:
+            timestamp, selpro_output = time.time(), run_cmd(base_path, QUERY_NAMES)
+            if RECORD_DIR:
+                common.record_output(RECORD_DIR, 'selpro', timestamp, selpro_output.encode())
+        else:
+            timestamp, selpro_output = recording
 
         if DEBUG:
-            print(f"[DEBUG] selpro_output: \n[{selpro_output}]\n")
-        
-        # Counts HOLD occurrences
-        count_hold = selpro_output.count('HOLD')
-        ibm_cd_hold_total.set(count_hold)
-        print(f"[INFO] Processes in HOLD: {count_hold}")
-
-        # Counts WAIT occurrences
-        count_wait = selpro_output.count('WAIT')
-        ibm_cd_wait_total.set(count_wait)
-        print(f"[INFO] Processes in WAIT: {count_wait}")
-
-        # Counts TIMER occurrences
-        count_timer = selpro_output.count('TIMER')
-        ibm_cd_timer_total.set(count_timer)
-        print(f"[INFO] Processes in TIMER: {count_timer}")
-
-        # Counts EXEC occurrences
-        count_exec = selpro_output.count('EXEC')
-        ibm_cd_exec_total.set(count_exec)
-        print(f"[INFO] Processes in EXEC: {count_exec}")
+            logger.debug('selpro_output:\n[%s]', selpro_output)
+
+        results, errors = parse_batch(selpro_output, QUERY_NAMES)
+        for query in errors:
+            ibm_cd_cli_query_errors.labels(query).inc()
+        if errors:
+            # One line per cycle, the rate limiter would otherwise hide every failed query but the first
+            logger.error('CLI queries failed %s', '; '.join(f'query={query}: {" | ".join(lines)}' for query, lines in errors.items()))
+        if 'selpro' in errors:
+            raise Exception("selpro query failed")
+        queue_totals, by_snode = aggregate_by_snode(results.get('selpro', []), MAX_SNODES)
+        count_hold = queue_totals['HOLD']
+        count_wait = queue_totals['WAIT']
+        count_timer = queue_totals['TIMER']
+        count_exec = queue_totals['EXEC']
+
+        # Only the series that changed since the previous cycle are written to the registry
+        changes = [queue_snapshots[queue].apply({(): count}) for queue, count in queue_totals.items()]
+        changes.append(snode_snapshot.apply(by_snode))
+        if hotspots is not None:
+            hotspots.observe(((r.get('process name', ''), r.get('process number') or r.get('process name', ''),
+                               r.get('queue', '').upper(), (r.get('status') or r.get('process status') or '').upper()[:2],
+                               common.retry_count(r.get('retries') or r.get('retry count')))
+                              for r in results.get('selpro', [])), timestamp)
+            changes.append(hotspot_snapshot.apply(hotspots.worst()))
+        changes.append(query_snapshot.apply({(query,): len(records) for query, records in results.items()}))
+        updated = sum(u for u, _ in changes)
+        removed = sum(r for _, r in changes)
+
+        logger.log(logging.INFO if updated or removed else logging.DEBUG,
+                   'collected node=%s hold=%d wait=%d timer=%d exec=%d series_updated=%d series_removed=%d',
+                   node, count_hold, count_wait, count_timer, count_exec, updated, removed)
+
+        server.record_history(node, {
+            'ibm_cd_processes_hold_total': count_hold,
+            'ibm_cd_processes_wait_total': count_wait,
+            'ibm_cd_processes_timer_total': count_timer,
+            'ibm_cd_processes_exec_total': count_exec
+        }, timestamp)
+
+        server.publish_snapshot()
+        return True
             
     except Exception as e:
-        print(f"[ERROR] Failed to collect metrics: {e}")
+        logger.error('Failed to collect metrics: %s', e)
         ibm_cd_scrape_errors.inc()
+        server.publish_snapshot(collected=False)
+        return False
 
 def main():
+    global DEBUG, MAX_SNODES, RECORD_DIR, QUERY_NAMES, hotspots
+
     """Starts the Prometheus exporter"""
     parser = argparse.ArgumentParser(description="IBM Connect:Direct Prometheus Exporter")
-    parser.add_argument('--base-path', required=True, help='Base path for IBM Connect:Direct installation')
+    parser.add_argument('--base-path', help='Base path for IBM Connect:Direct installation')
     parser.add_argument('--port', type=int, default=9400, help='Port to listen on')
     parser.add_argument('--interval', type=int, default=60, help='Scrape interval in seconds')
+    parser.add_argument('--max-snodes', type=int, default=MAX_SNODES, help='Maximum number of remote nodes exported by ibm_cd_processes_by_snode, the rest are grouped as __other__')
+    parser.add_argument('--queries', default=','.join(QUERY_NAMES), help=f'Comma separated CLI queries sent in one direct session each cycle, from: {", ".join(CLI_QUERIES)}. selpro is required')
+    parser.add_argument('--node', help='Node name used on /history, defaults to the last component of the base path')
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE, help='Number of collection cycles kept per node and metric for /history')
+    parser.add_argument('--record', metavar='DIR', help='Save each raw selpro output, gzip compressed, in DIR')
+    parser.add_argument('--replay', metavar='DIR', help='Collect from the selpro outputs recorded in DIR instead of running selpro, then exit')
+    parser.add_argument('--synthetic', type=int, metavar='PROCESSES', help='Collect from a generated TCQ with PROCESSES processes instead of running selpro, for load tests')
+    parser.add_argument('--textfile', metavar='PATH', help='Collect once, write the metrics to PATH (node_exporter textfile collector format) and exit, for cron and sidecar runs')
+    parser.add_argument('--replay-realtime', action='store_true', help='Replay at the recorded pace instead of as fast as possible')
+    parser.add_argument('--hotspot-top-k', type=int, default=HOTSPOT_TOP_K, help='Worst offending process names exported per kind by ibm_cd_process_hotspot, 0 disables the analysis')
+    parser.add_argument('--hotspot-half-life', type=int, default=HOTSPOT_HALF_LIFE, help='Seconds after which the hot-spot counters have decayed by half')
+    parser.add_argument('--debug', action='store_true', help='Enable debug output')
+    parser.add_argument('--log-rate-limit', type=int, default=LOG_RATE_LIMIT, help='Minimum seconds between two log lines of the same kind, 0 disables rate limiting')
     args = parser.parse_args()
+    if args.history_size < 1:
+        parser.error('--history-size must be at least 1')
 
     port = args.port
     interval = args.interval
     base_path = args.base_path
+    MAX_SNODES = args.max_snodes
+    server.history_size = args.history_size
+    RECORD_DIR = args.record
+    QUERY_NAMES = tuple(q.strip() for q in args.queries.split(',') if q.strip())
+    unknown = [q for q in QUERY_NAMES if q not in CLI_QUERIES]
+    if unknown:
+        parser.error(f'unknown CLI queries: {", ".join(unknown)}. Available: {", ".join(CLI_QUERIES)}')
+    if 'selpro' not in QUERY_NAMES:
+        # The queue gauges come from selpro, without it every cycle would export zeroes
+        parser.error('--queries must include selpro')
+    node = args.node or os.path.basename((base_path or args.replay or '').rstrip('/')) or 'synthetic'
+    DEBUG = args.debug
+    if args.hotspot_top_k > 0:
+        hotspots = common.HotSpotTracker(args.hotspot_top_k, args.hotspot_half_life)
+    common.setup_logging(DEBUG, args.log_rate_limit)
 
-    print(f"[INFO] Starting IBM Connect:Direct Prometheus Exporter on port {port}")
-    print(f"[INFO] Collection interval: {interval} seconds")
-    print(f"[INFO] Base path: {base_path}")
+    logger.info('Starting IBM Connect:Direct Prometheus Exporter on port %s', port)
+    logger.info('Collection interval: %s seconds', interval)
+    logger.info('Base path: %s', base_path)
     
-    if not base_path:
-        print("[ERROR] Base path is required")
+    if not base_path and not args.replay and not args.synthetic:
+        logger.error('Base path is required')
         exit(1)
+
+    if not args.replay and not args.synthetic:
+        problems = check_node(base_path)
+        if problems:
+            logger.error('Startup checks failed: %s', '; '.join(problems))
+            exit(1)
+
+    logger.info('CLI queries: %s', ', '.join(QUERY_NAMES))
+
+    if RECORD_DIR:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        logger.info('Recording selpro outputs to: %s', RECORD_DIR)
     
-    # Starts the Prometheus HTTP server
-    start_http_server(port, registry=registry)
-    
-    # Infinite loop to collect metrics
-    while True:
-        print(f"\n[INFO] Collecting metrics at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-        collect_metrics(base_path)
-        time.sleep(interval)
+    if args.textfile:
+        success = collect_metrics(base_path, node)
+        # A failed run only writes the error counter, so node_exporter never serves zeroed queue gauges as data
+        write_to_textfile(args.textfile, registry if success else registry.restricted_registry(
+            ['ibm_cd_scrape_errors_total', 'ibm_cd_scrape_errors_created']))
+        exit(0 if success else 1)
+
+    if args.replay:
+        logger.info('Replaying selpro outputs from: %s', args.replay)
+        replay = lambda: common.replay_recordings(
+            args.replay, 'selpro', args.replay_realtime,
+            lambda timestamp, data: collect_metrics(base_path, node, (timestamp, data.decode())))
+        if not args.replay_realtime:
+            # Nothing could scrape a replay that runs as fast as possible, so no port is bound
+            replay()
+            return
+
+    import asyncio
+
+    if args.replay:
+        asyncio.run(server.serve_exporter(port, interval, replay, once=True))
+        return
+
+    if args.synthetic:
+        logger.info('Collecting from a synthetic TCQ of %d processes', args.synthetic)
+        asyncio.run(server.serve_exporter(port, interval, lambda: collect_metrics(
+            base_path, node, (time.time(), synthetic_output(args.synthetic, time.time())))))
+        return
+
+    # Serves the HTTP endpoints and collects metrics every interval until interrupted
+    asyncio.run(server.serve_exporter(port, interval, lambda: collect_metrics(base_path, node)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
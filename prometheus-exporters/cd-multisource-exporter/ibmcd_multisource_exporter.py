@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import argparse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from prometheus_client import Gauge, Counter
+from prometheus_client.core import CollectorRegistry
+
+INTERVAL=60
+LOCALPORT=9404
+MAX_SNODES=50
+DIVERGENCE_THRESHOLD=5
+QUEUES = ('HOLD', 'WAIT', 'TIMER', 'EXEC')
+
+EXPORTERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_exporter(relative_path, name):
+    """Imports a sibling exporter script as a module, its sources and parsers are reused as is"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(EXPORTERS_DIR, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+cli = load_exporter('cd-cli-exporter/ibmcd_cli_exporter.py', 'ibmcd_cli_exporter')
+rest = load_exporter('cd-restapi-exporter/ibmcd_restapi_exporter.py', 'ibmcd_restapi_exporter')
+
+# Loaded by both exporters above, so already importable
+import ibmcd_exporter_common as common
+
+logger = common.logger
+
+# Creates the registry
+registry = CollectorRegistry()
+
+# Serves the registry on /metrics and keeps the /history ring buffers
+server = common.MetricsServer(registry, cli.HISTORY_SIZE)
+
+# Defines the metrics, every series carries the source it was collected from
+ibm_cd_queue_totals = {
+    queue: Gauge(
+        f'ibm_cd_processes_{queue.lower()}_total',
+        f'Total processes in {queue} state, from the first source that answered',
+        ['source'],
+        registry=registry
+    ) for queue in QUEUES
+}
+
+ibm_cd_processes_by_snode = Gauge(
+    'ibm_cd_processes_by_snode',
+    'Total processes per TCQ queue and remote node (SNODE), from the first source that answered',
+    ['queue', 'snode', 'source'],
+    registry=registry
+)
+
+ibm_cd_source_processes = Gauge(
+    'ibm_cd_source_processes',
+    'Total processes per TCQ queue as seen by each source, for cross-checking',
+    ['source', 'queue'],
+    registry=registry
+)
+
+ibm_cd_source_collect_seconds = Gauge(
+    'ibm_cd_source_collect_seconds',
+    'Duration of the last collection of each source',
+    ['source'],
+    registry=registry
+)
+
+ibm_cd_source_first = Counter(
+    'ibm_cd_source_first',
+    'Collection cycles where the source answered first and its result was used',
+    ['source'],
+    registry=registry
+)
+
+ibm_cd_source_divergence = Gauge(
+    'ibm_cd_source_divergence',
+    'Absolute difference between the CLI and REST queue counts of the last cycle',
+    ['queue'],
+    registry=registry
+)
+
+ibm_cd_source_diverged = Gauge(
+    'ibm_cd_source_diverged',
+    '1 when the CLI and REST queue counts differ by more than the divergence threshold',
+    ['queue'],
+    registry=registry
+)
+
+ibm_cd_source_divergence_events = Counter(
+    'ibm_cd_source_divergence_events',
+    'Collection cycles where the CLI and REST queue counts differed by more than the divergence threshold',
+    ['queue'],
+    registry=registry
+)
+
+ibm_cd_scrape_errors = Counter(
+    'ibm_cd_scrape_errors_total',
+    'Total errors when collecting IBM Connect:Direct metrics',
+    ['source'],
+    registry=registry
+)
+
+queue_snapshots = {queue: common.GaugeSnapshot(gauge) for queue, gauge in ibm_cd_queue_totals.items()}
+snode_snapshot = common.GaugeSnapshot(ibm_cd_processes_by_snode)
+source_snapshot = common.GaugeSnapshot(ibm_cd_source_processes)
+collect_seconds_snapshot = common.GaugeSnapshot(ibm_cd_source_collect_seconds)
+divergence_snapshot = common.GaugeSnapshot(ibm_cd_source_divergence)
+diverged_snapshot = common.GaugeSnapshot(ibm_cd_source_diverged)
+
+# Future of the last collection submitted for each source, a source never runs twice at the same time
+running = {}
+
+def cli_source(base_path, max_snodes, timeout):
+    """Returns the CLI source: selpro in one direct session, killed after timeout seconds"""
+    def collect():
+        results, errors = cli.parse_batch(cli.run_cmd(base_path, ('selpro',), timeout), ('selpro',))
+        if errors:
+            raise Exception(f"selpro query failed: {' | '.join(errors['selpro'])}")
+        return cli.aggregate_by_snode(results['selpro'], max_snodes)
+    return collect
+
+def rest_source(cdws_config, max_snodes, timeout):
+    """Returns the REST source: processcontrolcriterias through CDWS, signing on again after a failure.
+
+    timeout (seconds) bounds the connection and each read of every request.
+    """
+    state = {'signon_data': None}
+
+    def collect():
+        if state['signon_data'] is None:
+            state['signon_data'] = rest.signon(cdws_config, timeout=(timeout, timeout))
+            if state['signon_data'] is None:
+                raise Exception("CDWS signon failed")
+
+        records = rest.tcq_metrics(cdws_config, state['signon_data'], timeout=(timeout, timeout))
+        if records is False:
+            state['signon_data'] = None
+            raise Exception("Failed to retrieve TCQ metrics")
+        return rest.aggregate_by_snode(records, max_snodes)
+    return collect
+
+def timed(collect):
+    started = time.perf_counter()
+    queue_totals, by_snode = collect()
+    return time.perf_counter() - started, queue_totals, by_snode
+
+def publish_primary(source, queue_totals, by_snode, node, timestamp):
+    """Exports the result of the first source that answered, labelled with that source"""
+    for queue, snapshot in queue_snapshots.items():
+        snapshot.apply({(source,): queue_totals[queue]})
+    snode_snapshot.apply({(queue, snode, source): count for (queue, snode), count in by_snode.items()})
+    ibm_cd_source_first.labels(source).inc()
+
+    server.record_history(node, {
+        f'ibm_cd_processes_{queue.lower()}_total': count for queue, count in queue_totals.items()
+    }, timestamp)
+    server.publish_snapshot()
+
+def cross_check(results, threshold):
+    """Compares the CLI and REST queue counts and flags the queues that diverge by more than threshold.
+
+    The series of a source without a result this cycle are removed, and so are the divergence series
+    when there is nothing to compare, so no alert fires on a previous cycle's comparison.
+    """
+    source_snapshot.apply({(source, queue): count for source, (_, queue_totals, _) in results.items()
+                           for queue, count in queue_totals.items()})
+    collect_seconds_snapshot.apply({(source,): elapsed for source, (elapsed, _, _) in results.items()})
+
+    divergence = {}
+    if len(results) == 2:
+        cli_totals = results['cli'][1]
+        rest_totals = results['rest'][1]
+        divergence = {queue: abs(cli_totals[queue] - rest_totals[queue]) for queue in QUEUES}
+        diverged = [queue for queue, difference in divergence.items() if difference > threshold]
+        for queue in diverged:
+            ibm_cd_source_divergence_events.labels(queue).inc()
+        if diverged:
+            # One line per cycle, the rate limiter would otherwise hide every diverged queue but the first
+            logger.warning('sources diverged threshold=%d %s', threshold,
+                           ' '.join(f'{queue}:cli={cli_totals[queue]},rest={rest_totals[queue]}' for queue in diverged))
+
+    divergence_snapshot.apply({(queue,): difference for queue, difference in divergence.items()})
+    diverged_snapshot.apply({(queue,): 1 if difference > threshold else 0 for queue, difference in divergence.items()})
+
+def collect_metrics(executor, sources, node, source_timeout, cross_check_timeout, threshold):
+    """Runs every source in parallel, exports the first result and cross-checks it with the others.
+
+    The first result is awaited for up to source_timeout, the others for cross_check_timeout once it is in.
+    """
+    timestamp = time.time()
+    futures = {}
+    for source, collect in sources.items():
+        previous = running.get(source)
+        if previous is not None and not previous.done():
+            # Still stuck in the previous cycle, a second run would only pile up behind it
+            logger.warning('Source still running from the previous cycle source=%s, skipping it', source)
+            ibm_cd_scrape_errors.labels(source).inc()
+            continue
+        running[source] = future = executor.submit(timed, collect)
+        futures[future] = source
+
+    results = {}
+    pending = set(futures)
+    deadline = time.monotonic() + source_timeout
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            source = futures[future]
+            try:
+                results[source] = future.result()
+            except Exception as e:
+                logger.error('Failed to collect metrics source=%s: %s', source, e)
+                ibm_cd_scrape_errors.labels(source).inc()
+                continue
+
+            if len(results) == 1:
+                elapsed, queue_totals, by_snode = results[source]
+                publish_primary(source, queue_totals, by_snode, node, timestamp)
+                logger.debug('collected source=%s seconds=%.3f hold=%d wait=%d timer=%d exec=%d', source, elapsed,
+                             queue_totals['HOLD'], queue_totals['WAIT'], queue_totals['TIMER'], queue_totals['EXEC'])
+                # The cross-check only waits for the slower sources once there is something to compare them with
+                deadline = time.monotonic() + cross_check_timeout
+
+    if pending:
+        late = ','.join(futures[f] for f in pending)
+        if results:
+            logger.warning('No result within %ss of the first one from source=%s, skipping its cross-check', cross_check_timeout, late)
+        else:
+            logger.warning('No result within %ss from source=%s', source_timeout, late)
+        for future in pending:
+            ibm_cd_scrape_errors.labels(futures[future]).inc()
+
+    cross_check(results, threshold)
+    server.publish_snapshot(collected=bool(results))
+    return bool(results)
+
+def main():
+    """Starts the multi-source Prometheus exporter"""
+    parser = argparse.ArgumentParser(description="IBM Connect:Direct multi-source (CLI + REST) Prometheus Exporter")
+    parser.add_argument('--base-path', required=True, help='Base path for IBM Connect:Direct installation')
+    parser.add_argument('--cdws_server', required=True, help='IBM Connect:Direct Web Services server URL. Sample: https://localhost:9443')
+    parser.add_argument('--cd_ipaddress', required=True, help='IBM Connect:Direct Web Services node')
+    parser.add_argument('--cd_user', required=True, help='IBM Connect:Direct Web Services username')
+    parser.add_argument('--cd_pw', required=True, help='IBM Connect:Direct Web Services password')
+    parser.add_argument('--cd_port', default="1363", help='IBM Connect:Direct Web Services node')
+    parser.add_argument('--cd_protocol', default="TLS1.3", help='C:D Web Services node')
+    parser.add_argument('--port', type=int, default=LOCALPORT, help='Port to listen on')
+    parser.add_argument('--interval', type=int, default=INTERVAL, help='Scrape interval in seconds')
+    parser.add_argument('--max-snodes', type=int, default=MAX_SNODES, help='Maximum number of remote nodes exported by ibm_cd_processes_by_snode, the rest are grouped as __other__')
+    parser.add_argument('--divergence-threshold', type=int, default=DIVERGENCE_THRESHOLD, help='Queue count difference between CLI and REST above which ibm_cd_source_diverged fires')
+    parser.add_argument('--cross-check-timeout', type=float, help='Seconds to wait for the slower source once the first one has answered, defaults to half the interval')
+    parser.add_argument('--source-timeout', type=float, help='Seconds after which a source is abandoned: the direct session is killed, the CDWS requests time out. Defaults to the interval')
+    parser.add_argument('--node', help='Node name used on /history, defaults to --cd_ipaddress')
+    parser.add_argument('--debug', action='store_true', help='Enable debug output')
+    parser.add_argument('--log-rate-limit', type=int, default=cli.LOG_RATE_LIMIT, help='Minimum seconds between two log lines of the same kind, 0 disables rate limiting')
+    args = parser.parse_args()
+
+    port = args.port
+    interval = args.interval
+    base_path = args.base_path
+    node = args.node or args.cd_ipaddress
+    cross_check_timeout = args.cross_check_timeout or interval / 2
+    source_timeout = args.source_timeout or interval
+    cdws_config = {
+        "cdws_server": args.cdws_server,
+        "cd_username": args.cd_user,
+        "cd_password": args.cd_pw,
+        "cd_ipaddress": args.cd_ipaddress,
+        "cd_port": args.cd_port,
+        "cd_protocol": args.cd_protocol
+    }
+    common.setup_logging(args.debug, args.log_rate_limit)
+
+    logger.info('Starting IBM Connect:Direct multi-source Prometheus Exporter on port %s', port)
+    logger.info('Collection interval: %s seconds', interval)
+    logger.info('Base path: %s', base_path)
+    logger.info('CDWS server: %s', cdws_config['cdws_server'])
+    logger.info('C:D IP address: %s', cdws_config['cd_ipaddress'])
+    logger.info('Divergence threshold: %s processes', args.divergence_threshold)
+
+    problems = cli.check_node(base_path)
+    if problems:
+        logger.error('Startup checks failed: %s', '; '.join(problems))
+        exit(1)
+
+    # requests/urllib3 are only loaded when talking to CDWS
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    sources = {
+        'cli': cli_source(base_path, args.max_snodes, source_timeout),
+        'rest': rest_source(cdws_config, args.max_snodes, source_timeout)
+    }
+
+    import asyncio
+
+    # One worker per source, a source is skipped while its previous run is still going
+    with ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='source') as executor:
+        asyncio.run(server.serve_exporter(port, interval, lambda: collect_metrics(
+            executor, sources, node, source_timeout, cross_check_timeout, args.divergence_threshold)))
+
+if __name__ == '__main__':
+    main()
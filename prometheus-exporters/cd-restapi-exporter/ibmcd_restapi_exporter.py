@@ -1,20 +1,32 @@
 #!/usr/bin/env python3
 
 import base64
+import logging
+import os
+import sys
 import time
 import argparse
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import Gauge, Counter
 from prometheus_client.core import CollectorRegistry
-import requests
-from requests.exceptions import ConnectTimeout, ReadTimeout
-import urllib3
 import json
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Code shared by the Prometheus exporters, in the common directory next to this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import ibmcd_exporter_common as common
 
 DEBUG=False
 INTERVAL=60
 LOCALPORT=9402
+MAX_SNODES=50
+HISTORY_SIZE=720
+RECORD_DIR=None
+LOG_RATE_LIMIT=60
+HOTSPOT_TOP_K=10
+HOTSPOT_HALF_LIFE=3600
+
+# Label used for remote nodes beyond MAX_SNODES, keeps cardinality bounded
+OTHER_SNODE = '__other__'
+QUEUES = ('HOLD', 'WAIT', 'TIMER', 'EXEC')
 
 # Global variable to hold signon data
 signon_data = None
@@ -54,6 +66,20 @@ ibm_cd_process_count = Gauge(
     registry=registry
 )
 
+ibm_cd_processes_by_snode = Gauge(
+    'ibm_cd_processes_by_snode',
+    'Total processes per TCQ queue and remote node (SNODE)',
+    ['queue', 'snode'],
+    registry=registry
+)
+
+ibm_cd_process_hotspot = Gauge(
+    'ibm_cd_process_hotspot',
+    'Worst offending process names by kind: retries, held_error (entries in HOLD due to error) and timer_seconds, decaying over time',
+    ['kind', 'process_name'],
+    registry=registry
+)
+
 ibm_cd_scrape_errors = Counter(
     'ibm_cd_scrape_errors_total',
     'Total errors when collecting IBM Connect:Direct metrics',
@@ -61,8 +87,16 @@ ibm_cd_scrape_errors = Counter(
 )
 
 
+logger = common.logger
+
+# Serves the registry on /metrics and keeps the /history ring buffers
+server = common.MetricsServer(registry, HISTORY_SIZE)
+
+
+def signon(cdws_config, timeout=(30, 30)):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
 
-def signon(cdws_config):
     url = f'{cdws_config["cdws_server"]}/cdwebconsole/svc/signon'
 
     # Encode the credentials (username:password) in Base64 format.
@@ -85,26 +119,29 @@ def signon(cdws_config):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=jsonBody, verify=False)
+        response = requests.post(url, headers=headers, json=jsonBody, timeout=timeout, verify=False)
     except ConnectTimeout:
-        print('[ERROR] signon: Connection timeout')
+        logger.error('signon: Connection timeout')
         return None
     except ReadTimeout:
-        print('[ERROR] signon: Read timeout')
+        logger.error('signon: Read timeout')
         return None
     except Exception as e:
-        print(f'[ERROR] signon: Exception - {e}')
+        logger.error('signon: Exception - %s', e)
         return None
 
     if (response.status_code != 200):
-        print('[ERROR] signon: Failed = ', response.json())
+        logger.error('signon: Failed = %s', response.text)
         return None
 
-    print('[INFO] signon: OK')
+    logger.info('signon: OK')
     return response.headers
 
 
 def signout(cdws_config, signon_data):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
+
     url = f'{cdws_config["cdws_server"]}/cdwebconsole/svc/signout'
     headers = {
         "Accept": "application/json", "Content-Type": "application/json; charset=utf-8",
@@ -123,156 +160,255 @@ def signout(cdws_config, signon_data):
         return False
     
     if response.ok:
-        print("[INFO] signout: OK ")
+        logger.info('signout: OK')
     else:
-        print("[ERROR] signout: Failed = " + response.text)
+        logger.error('signout: Failed = %s', response.text)
 
 
-def tcq_metrics(cdws_config, signon_data):
+def tcq_metrics(cdws_config, signon_data, timeout=(30, 30)):
+    import requests
+    from requests.exceptions import ConnectTimeout, ReadTimeout
+
     headers = {
         "Accept": "application/json", "Content-Type": "application/json; charset=utf-8",
         "X-XSRF-TOKEN": signon_data["_csrf"], "Authorization": signon_data["authorization"], "Cookie": signon_data["set-cookie"]
     }
     url = f"{cdws_config['cdws_server']}/cdwebconsole/svc/processcontrolcriterias?queue=all"
     try:
-        response = requests.get(url=url, headers=headers, timeout=(30, 30), verify=False)
+        response = requests.get(url=url, headers=headers, timeout=timeout, verify=False)
 
         if (response.status_code != 200):
-            print('[ERROR] tcq_metrics: Failed = ', response.json())
+            logger.error('tcq_metrics: Failed = %s', response.text)
             return False
 
     except ConnectTimeout:
-        print('[ERROR] tcq_metrics: Connection timeout')
+        logger.error('tcq_metrics: Connection timeout')
         return False
     except ReadTimeout:
-        print('[ERROR] tcq_metrics: Read timeout')
+        logger.error('tcq_metrics: Read timeout')
         return False
     except Exception as e:
-        print(f'[ERROR] tcq_metrics: Exception - {e}')
+        logger.error('tcq_metrics: Exception - %s', e)
         return False
     
     if response.ok:
+        if RECORD_DIR:
+            common.record_output(RECORD_DIR, 'tcq', time.time(), response.content)
         return response.json()
     return False
 
 
-def collect_metrics(cdws_config, signon_data):
-    """Collects IBM Connect:Direct metrics and updates Prometheus metrics"""
+def aggregate_by_snode(records, max_snodes=MAX_SNODES):
+    """Aggregates TCQ records in one pass into queue totals and a {(queue, snode): count} table.
+
+    Remote nodes beyond max_snodes (by number of processes) are folded into OTHER_SNODE.
+    """
+    queue_totals = dict.fromkeys(QUEUES, 0)
+    by_snode = {}
+    snode_totals = {}
+    for item in records:
+        if not isinstance(item, dict):
+            continue
+        queue = item.get('queue', '')
+        if queue not in queue_totals:
+            continue
+        snode = (item.get('snode') or item.get('sNode') or item.get('remoteNode') or '').upper() or 'UNKNOWN'
+        queue_totals[queue] += 1
+        by_snode[(queue, snode)] = by_snode.get((queue, snode), 0) + 1
+        snode_totals[snode] = snode_totals.get(snode, 0) + 1
+
+    if len(snode_totals) > max_snodes:
+        kept = set(sorted(snode_totals, key=snode_totals.get, reverse=True)[:max_snodes])
+        folded = {}
+        for (queue, snode), count in by_snode.items():
+            key = (queue, snode if snode in kept else OTHER_SNODE)
+            folded[key] = folded.get(key, 0) + count
+        by_snode = folded
+
+    return queue_totals, by_snode
+
+
+# Last written state of each gauge, unlabeled gauges use the () label set
+queue_snapshots = {
+    'HOLD': common.GaugeSnapshot(ibm_cd_hold_total),
+    'WAIT': common.GaugeSnapshot(ibm_cd_wait_total),
+    'TIMER': common.GaugeSnapshot(ibm_cd_timer_total),
+    'EXEC': common.GaugeSnapshot(ibm_cd_exec_total)
+}
+snode_snapshot = common.GaugeSnapshot(ibm_cd_processes_by_snode)
+
+# Created in main() once the hot-spot arguments are parsed
+hotspots = None
+hotspot_snapshot = common.GaugeSnapshot(ibm_cd_process_hotspot)
+
+
+def collect_metrics(cdws_config, signon_data, recording=None):
+    """Collects IBM Connect:Direct metrics and updates Prometheus metrics.
+
+    recording is an optional (timestamp, TCQ records) pair used instead of calling CDWS.
+    """
     try:
-        selpro_output = tcq_metrics(cdws_config, signon_data)
+        if recording is None:
+            timestamp, selpro_output = time.time(), tcq_metrics(cdws_config, signon_data)
+        else:
+            timestamp, selpro_output = recording
         if selpro_output is False:
             raise Exception("Failed to retrieve TCQ metrics")
 
         if DEBUG:
-            print(f"[DEBUG] selpro_output: \n[{selpro_output}]\n")
-
-        count_hold = 0
-        count_exec = 0
-        count_wait = 0
-        count_timer = 0
-
-        # Flatten the nested list structure
-        for item in selpro_output:
-            if isinstance(item, dict):
-                queue_value = item.get('queue', '')
-
-                if queue_value == 'HOLD':
-                    count_hold += 1
-                elif queue_value == 'EXEC':
-                    count_exec += 1
-                elif queue_value == 'WAIT':
-                    count_wait += 1
-                elif queue_value == 'TIMER':
-                    count_timer += 1
-
-        # Counts HOLD occurrences
-        ibm_cd_hold_total.set(count_hold)
-        print(f"[INFO] Processes in HOLD: {count_hold}")
-
-        # Counts WAIT occurrences
-        ibm_cd_wait_total.set(count_wait)
-        print(f"[INFO] Processes in WAIT: {count_wait}")
-
-        # Counts TIMER occurrences
-        ibm_cd_timer_total.set(count_timer)
-        print(f"[INFO] Processes in TIMER: {count_timer}")
-
-        # Counts EXEC occurrences
-        ibm_cd_exec_total.set(count_exec)
-        print(f"[INFO] Processes in EXEC: {count_exec}")
+            logger.debug('selpro_output:\n[%s]', selpro_output)
+
+        # Single pass over the TCQ records for both the queue totals and the per-SNODE table
+        queue_totals, by_snode = aggregate_by_snode(selpro_output, MAX_SNODES)
+        count_hold = queue_totals['HOLD']
+        count_exec = queue_totals['EXEC']
+        count_wait = queue_totals['WAIT']
+        count_timer = queue_totals['TIMER']
+
+        # Only the series that changed since the previous cycle are written to the registry
+        changes = [queue_snapshots[queue].apply({(): count}) for queue, count in queue_totals.items()]
+        changes.append(snode_snapshot.apply(by_snode))
+        if hotspots is not None:
+            hotspots.observe(((item.get('processName', ''), item.get('processNumber') or item.get('processName', ''),
+                               item.get('queue', ''), str(item.get('status') or '').upper()[:2],
+                               common.retry_count(item.get('retryCount', item.get('retries'))))
+                              for item in selpro_output if isinstance(item, dict)), timestamp)
+            changes.append(hotspot_snapshot.apply(hotspots.worst()))
+        updated = sum(u for u, _ in changes)
+        removed = sum(r for _, r in changes)
+
+        logger.log(logging.INFO if updated or removed else logging.DEBUG,
+                   'collected node=%s hold=%d wait=%d timer=%d exec=%d series_updated=%d series_removed=%d',
+                   cdws_config['cd_ipaddress'], count_hold, count_wait, count_timer, count_exec, updated, removed)
+
+        server.record_history(cdws_config['cd_ipaddress'], {
+            'ibm_cd_processes_hold_total': count_hold,
+            'ibm_cd_processes_wait_total': count_wait,
+            'ibm_cd_processes_timer_total': count_timer,
+            'ibm_cd_processes_exec_total': count_exec
+        }, timestamp)
         
+        server.publish_snapshot()
         return True
             
     except Exception as e:
-        print(f"[ERROR] Failed to collect metrics: {e}")
+        logger.error('Failed to collect metrics: %s', e)
         ibm_cd_scrape_errors.inc()
+        server.publish_snapshot(collected=False)
         return False
 
 
 def main():
+    global DEBUG, MAX_SNODES, RECORD_DIR, hotspots
+
     """Starts the Prometheus exporter"""
     parser = argparse.ArgumentParser(description="IBM Connect:Direct Prometheus Exporter")
-    parser.add_argument('--cdws_server', required=True, help='IBM Connect:Direct Web Services server URL. Sample: https://localhost:9443')
+    parser.add_argument('--cdws_server', help='IBM Connect:Direct Web Services server URL. Sample: https://localhost:9443')
     #parser.add_argument('--cdws_user', required=True, help='IBM Connect:Direct Web Services username')
     #parser.add_argument('--cdws_pw', required=True, help='IBM Connect:Direct Web Services password')
     #parser.add_argument('--node', help='IBM Connect:Direct Web Services node')
 
-    parser.add_argument('--cd_ipaddress', required=True, help='IBM Connect:Direct Web Services node')
-    parser.add_argument('--cd_user', required=True, help='IBM Connect:Direct Web Services username')
-    parser.add_argument('--cd_pw', required=True, help='IBM Connect:Direct Web Services password')
+    parser.add_argument('--cd_ipaddress', help='IBM Connect:Direct Web Services node')
+    parser.add_argument('--cd_user', help='IBM Connect:Direct Web Services username')
+    parser.add_argument('--cd_pw', help='IBM Connect:Direct Web Services password')
 
     parser.add_argument('--cd_port', default="1363", help='IBM Connect:Direct Web Services node')
     parser.add_argument('--cd_protocol', default="TLS1.3", help='C:D Web Services node')
     parser.add_argument('--port', type=int, default=LOCALPORT, help='Port to listen on')
     parser.add_argument('--interval', type=int, default=INTERVAL, help='Scrape interval in seconds')
+    parser.add_argument('--max-snodes', type=int, default=MAX_SNODES, help='Maximum number of remote nodes exported by ibm_cd_processes_by_snode, the rest are grouped as __other__')
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE, help='Number of collection cycles kept per node and metric for /history')
+    parser.add_argument('--record', metavar='DIR', help='Save each raw processcontrolcriterias response body, gzip compressed, in DIR')
+    parser.add_argument('--replay', metavar='DIR', help='Collect from the responses recorded in DIR instead of calling CDWS, then exit')
+    parser.add_argument('--replay-realtime', action='store_true', help='Replay at the recorded pace instead of as fast as possible')
+    parser.add_argument('--hotspot-top-k', type=int, default=HOTSPOT_TOP_K, help='Worst offending process names exported per kind by ibm_cd_process_hotspot, 0 disables the analysis')
+    parser.add_argument('--hotspot-half-life', type=int, default=HOTSPOT_HALF_LIFE, help='Seconds after which the hot-spot counters have decayed by half')
+    parser.add_argument('--debug', action='store_true', help='Enable debug output')
+    parser.add_argument('--log-rate-limit', type=int, default=LOG_RATE_LIMIT, help='Minimum seconds between two log lines of the same kind, 0 disables rate limiting')
     args = parser.parse_args()
 
+    if not args.replay:
+        missing = [a for a in ('cdws_server', 'cd_ipaddress', 'cd_user', 'cd_pw') if not getattr(args, a)]
+        if missing:
+            parser.error('the following arguments are required: ' + ', '.join(f'--{a}' for a in missing))
+    if args.history_size < 1:
+        parser.error('--history-size must be at least 1')
+
     port = args.port
     interval = args.interval
+    MAX_SNODES = args.max_snodes
+    server.history_size = args.history_size
+    RECORD_DIR = args.record
+    DEBUG = args.debug
+    if args.hotspot_top_k > 0:
+        hotspots = common.HotSpotTracker(args.hotspot_top_k, args.hotspot_half_life)
+    common.setup_logging(DEBUG, args.log_rate_limit)
     cdws_config = {
         "cdws_server": args.cdws_server,
         "cd_username": args.cd_user,
         "cd_password": args.cd_pw,
-        "cd_ipaddress": args.cd_ipaddress,
+        "cd_ipaddress": args.cd_ipaddress or os.path.basename((args.replay or '').rstrip('/')),
         "cd_port": args.cd_port,
         "cd_protocol": args.cd_protocol
     }
 
-    print(f"[INFO] Starting IBM Connect:Direct Prometheus Exporter on port {port}")
-    print(f"[INFO] Collection interval: {interval} seconds")
-    print(f"[INFO] CDWS server: {cdws_config['cdws_server']}")
-    print(f"[INFO] C:D IP address: {cdws_config['cd_ipaddress']}")
-    print(f"[INFO] C:D username: {cdws_config['cd_username']}")
-    print(f"[INFO] C:D port: {cdws_config['cd_port']}")
-    print(f"[INFO] C:D protocol: {cdws_config['cd_protocol']}")
+    logger.info('Starting IBM Connect:Direct Prometheus Exporter on port %s', port)
+    logger.info('Collection interval: %s seconds', interval)
+    logger.info('CDWS server: %s', cdws_config['cdws_server'])
+    logger.info('C:D IP address: %s', cdws_config['cd_ipaddress'])
+    logger.info('C:D username: %s', cdws_config['cd_username'])
+    logger.info('C:D port: %s', cdws_config['cd_port'])
+    logger.info('C:D protocol: %s', cdws_config['cd_protocol'])
+
+    if args.replay:
+        logger.info('Replaying TCQ responses from: %s', args.replay)
+        replay = lambda: common.replay_recordings(
+            args.replay, 'tcq', args.replay_realtime,
+            lambda timestamp, data: collect_metrics(cdws_config, None, (timestamp, json.loads(data))))
+        if not args.replay_realtime:
+            # Nothing could scrape a replay that runs as fast as possible, so no port is bound
+            replay()
+            return
+
+    import asyncio
+
+    if args.replay:
+        logger.info('Starting Prometheus HTTP server on port %s', port)
+        asyncio.run(server.serve_exporter(port, interval, replay, once=True))
+        return
+
+    if RECORD_DIR:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        logger.info('Recording TCQ responses to: %s', RECORD_DIR)
+
+    # requests/urllib3 are only loaded when talking to CDWS, --help and --replay runs never import them
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     signon_data = signon(cdws_config)
     if signon_data is None:
         raise Exception("Initial signon failed")
     
-    # Starts the Prometheus HTTP server
-    print(f"[INFO] Starting Prometheus HTTP server on port {port}")
-    start_http_server(port, registry=registry)
+    def collect_cycle():
+        nonlocal signon_data
 
-    # Infinite loop to collect metrics
-    while True:
-        print(f"\n[INFO] Collecting metrics at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-        
         # Try to collect metrics
         success = collect_metrics(cdws_config, signon_data)
         
         # If collection failed, try to re-login
         if not success:
-            print("[WARN] Metric collection failed, attempting to re-login...")
+            logger.warning('Metric collection failed, attempting to re-login...')
             
             # Try to login again
             signon_data = signon(cdws_config)
             if signon_data is None:
-                print("[ERROR] Re-login failed, will retry in next interval")
+                logger.error('Re-login failed, will retry in next interval')
             else:
-                print("[INFO] Re-login successful")
-        
-        time.sleep(interval)
+                logger.info('Re-login successful')
+
+    # Starts the Prometheus HTTP server, collection runs in a worker thread every interval
+    logger.info('Starting Prometheus HTTP server on port %s', port)
+    asyncio.run(server.serve_exporter(port, interval, collect_cycle))
     
     signout(cdws_config, signon_data)
 
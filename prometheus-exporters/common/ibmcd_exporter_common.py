@@ -0,0 +1,453 @@
+"""Code shared by the IBM Connect:Direct Prometheus exporters"""
+
+import os
+import glob
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+from array import array
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+# Logger of every exporter, configured once by setup_logging()
+logger = logging.getLogger('ibmcd_exporter')
+
+# TCQ statuses of a process waiting in TIMER for a retry (WS, waiting for its start time, is not one)
+RETRY_STATUSES = ('RE',)
+
+# /ready fails when the last successful collection is older than READY_INTERVALS collection intervals,
+# /healthz when it is older than STALE_INTERVALS
+READY_INTERVALS=2
+STALE_INTERVALS=5
+
+class RateLimitFilter(logging.Filter):
+    """Lets each message template through at most once every period seconds and counts the ones dropped.
+
+    Keys are the unformatted templates, so memory is bounded by the log calls of the exporters.
+    """
+
+    def __init__(self, period):
+        super().__init__()
+        self.period = period
+        self.last_emitted = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        if self.period <= 0 or record.levelno <= logging.DEBUG:
+            return True
+
+        key = (record.levelno, record.msg)
+        last = self.last_emitted.get(key)
+        if last is not None and record.created - last < self.period:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+
+        self.last_emitted[key] = record.created
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f'{record.msg} suppressed={suppressed}'
+        return True
+
+def setup_logging(debug, rate_limit):
+    """Logs "[LEVEL] message" lines to stdout, rate limited per message template"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    handler.addFilter(RateLimitFilter(rate_limit))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    logger.propagate = False
+
+class GaugeSnapshot:
+    """Last values written to a gauge, so each cycle only writes the label sets that changed"""
+
+    def __init__(self, gauge):
+        self.gauge = gauge
+        self.values = {}
+        self.children = {}
+
+    def apply(self, current):
+        """Writes the changed entries of current ({label values: value}) and removes the label sets
+        that are no longer present. Returns the number of (updated, removed) series."""
+        removed = [labels for labels in self.values if labels not in current]
+        for labels in removed:
+            self.gauge.remove(*labels)
+            del self.values[labels]
+            self.children.pop(labels, None)
+
+        updated = 0
+        for labels, value in current.items():
+            if self.values.get(labels) == value:
+                continue
+            child = self.children.get(labels)
+            if child is None:
+                child = self.children[labels] = self.gauge.labels(*labels) if labels else self.gauge
+            child.set(value)
+            self.values[labels] = value
+            updated += 1
+
+        return updated, len(removed)
+
+def retry_count(value):
+    """Returns a TCQ retry counter as an int, None when the source does not report one"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class CountMinSketch:
+    """Approximate counters in a fixed depth x width table, memory does not grow with the number of keys.
+
+    Counters are stored divided by scale, so decaying every counter is a single multiplication.
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.rows = [array('d', bytes(8 * width)) for _ in range(depth)]
+        self.scale = 1.0
+
+    def add(self, key, value):
+        """Adds value to key and returns its new estimate, in stored (unscaled) units"""
+        estimate = None
+        for seed, row in enumerate(self.rows):
+            pos = hash((seed, key)) % self.width
+            row[pos] += value / self.scale
+            estimate = row[pos] if estimate is None else min(estimate, row[pos])
+        return estimate
+
+    def decay(self, factor):
+        """Multiplies every counter by factor, returns the factor stored values must be rescaled with (1.0 if none)"""
+        self.scale *= factor
+        if self.scale > 1e-9:
+            return 1.0
+
+        # Fold the scale back into the counters before the stored values overflow
+        rescale, self.scale = self.scale, 1.0
+        for row in self.rows:
+            for pos, count in enumerate(row):
+                if count:
+                    row[pos] = count * rescale
+        return rescale
+
+class HotSpotTracker:
+    """Rolling per-process-name retries, HOLD-due-to-error entries and TIMER time, in constant memory.
+
+    Each kind has a count-min sketch for the estimates and a top_k dict of the worst offenders.
+    Counts decay with the given half-life (seconds) so old incidents fade out.
+    """
+    KINDS = ('retries', 'held_error', 'timer_seconds')
+
+    def __init__(self, top_k, half_life, width=2048, depth=4):
+        self.top_k = top_k
+        self.half_life = half_life
+        self.sketches = {kind: CountMinSketch(width, depth) for kind in self.KINDS}
+        self.top = {kind: {} for kind in self.KINDS}
+        # State of the previous cycle, bounded by the TCQ size: processes in TIMER, in TIMER with a
+        # retry status, held in error, and the retry counter of each process that reports one
+        self.in_timer = set()
+        self.retrying = set()
+        self.held_error = set()
+        self.retry_counts = {}
+        self.last_timestamp = None
+
+    def observe(self, records, timestamp):
+        """Updates the counters from one cycle of (process name, process id, queue, status, retries) tuples.
+
+        status is '' and retries None when the source does not report them. The first cycle only records
+        the state: what is already in TIMER or HOLD at startup happened before the exporter was watching.
+        """
+        first = self.last_timestamp is None
+        elapsed = 0.0 if first else max(0.0, timestamp - self.last_timestamp)
+        if elapsed and self.half_life > 0:
+            self.decay(0.5 ** (elapsed / self.half_life))
+
+        in_timer = set()
+        retrying = set()
+        held_error = set()
+        retry_counts = {}
+        for name, process_id, queue, status, retries in records:
+            if retries is not None:
+                retry_counts[process_id] = retries
+            if queue == 'TIMER':
+                in_timer.add(process_id)
+                if status in RETRY_STATUSES:
+                    retrying.add(process_id)
+                if not first:
+                    self.observe_timer(name, process_id, status, retries)
+                if elapsed:
+                    self.add('timer_seconds', name, elapsed)
+            elif queue == 'HOLD' and status == 'HE':
+                held_error.add(process_id)
+                if not first and process_id not in self.held_error:
+                    self.add('held_error', name, 1)
+
+        self.in_timer = in_timer
+        self.retrying = retrying
+        self.held_error = held_error
+        self.retry_counts = retry_counts
+        self.last_timestamp = timestamp
+
+    def observe_timer(self, name, process_id, status, retries):
+        """Counts the retries of a process found in TIMER, using the most precise information available"""
+        if retries is not None:
+            # Retries made since the previous cycle, a process new to the TCQ made all of them since
+            previous = self.retry_counts.get(process_id, 0)
+            if retries > previous:
+                self.add('retries', name, retries - previous)
+        elif status:
+            # Only a retry status counts, TIMER also holds processes waiting for their start time
+            if status in RETRY_STATUSES and process_id not in self.retrying:
+                self.add('retries', name, 1)
+        elif process_id not in self.in_timer:
+            # No status at all: entering TIMER is the best available sign of a retry
+            self.add('retries', name, 1)
+
+    def add(self, kind, name, value):
+        estimate = self.sketches[kind].add(name, value)
+        top = self.top[kind]
+        if name in top or len(top) < self.top_k:
+            top[name] = estimate
+            return
+        weakest = min(top, key=top.get)
+        if estimate > top[weakest]:
+            del top[weakest]
+            top[name] = estimate
+
+    def decay(self, factor):
+        for kind in self.KINDS:
+            rescale = self.sketches[kind].decay(factor)
+            if rescale != 1.0:
+                top = self.top[kind]
+                for name in top:
+                    top[name] *= rescale
+
+    def worst(self):
+        """Returns the current worst offenders as {(kind, process name): score}, fully decayed ones left out"""
+        worst = {}
+        for kind in self.KINDS:
+            scale = self.sketches[kind].scale
+            for name, score in self.top[kind].items():
+                if score * scale >= 0.001:
+                    worst[(kind, name)] = round(score * scale, 3)
+        return worst
+
+class RingBuffer:
+    """Fixed-size ring buffer of (timestamp, value) samples backed by two preallocated arrays"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.next = 0
+        self.size = 0
+
+    def append(self, timestamp, value):
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def samples(self, since=0.0):
+        """Returns the stored samples, oldest first, with timestamp greater than since"""
+        start = (self.next - self.size) % self.capacity
+        result = []
+        for i in range(self.size):
+            pos = (start + i) % self.capacity
+            if self.timestamps[pos] > since:
+                result.append((self.timestamps[pos], self.values[pos]))
+        return result
+
+def gzip_accepted(accept_encoding):
+    """True when an Accept-Encoding header value allows gzip, a coding listed with q=0 is refused"""
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+class MetricsServer:
+    """Serves a registry on /metrics from a snapshot rendered once per collection cycle, with /history,
+    /healthz and /ready. The last history_size cycles of each node and metric are kept for /history.
+    """
+
+    def __init__(self, registry, history_size):
+        self.registry = registry
+        self.history_size = history_size
+        # Ring buffers of recent samples, keyed by (node, metric name)
+        self.history = {}
+        self.history_lock = threading.Lock()
+        # Latest /metrics exposition as (last successful collection time, body, gzipped body, collected), replaced as a whole
+        self.snapshot = (time.time(), b'', gzip.compress(b''), False)
+
+    def record_history(self, node, values, timestamp):
+        """Appends the values collected in one cycle ({metric name: value}) to the node ring buffers"""
+        with self.history_lock:
+            for metric, value in values.items():
+                buffer = self.history.get((node, metric))
+                if buffer is None:
+                    buffer = self.history[(node, metric)] = RingBuffer(self.history_size)
+                buffer.append(timestamp, value)
+
+    def render_history(self, query):
+        """Builds the /history response for the parsed query string, returns (status, content type, body)"""
+        node = query.get('node', [None])[0]
+        metric = query.get('metric', [None])[0]
+        output_format = query.get('format', ['json'])[0]
+        since = float(query.get('since', ['0'])[0])
+
+        with self.history_lock:
+            if node is None and len({n for n, _ in self.history}) == 1:
+                node = next(iter(self.history))[0]
+            buffer = self.history.get((node, metric))
+            if buffer is None:
+                available = sorted(f'{n}/{m}' for n, m in self.history)
+                return 404, 'application/json', json.dumps({'error': 'unknown node or metric', 'available': available}).encode()
+            samples = buffer.samples(since)
+
+        if output_format == 'csv':
+            body = 'timestamp,value\n' + ''.join(f'{ts:.3f},{value:g}\n' for ts, value in samples)
+            return 200, 'text/csv; charset=utf-8', body.encode()
+        body = json.dumps({'node': node, 'metric': metric, 'samples': samples})
+        return 200, 'application/json', body.encode()
+
+    def publish_snapshot(self, collected=True):
+        """Renders the registry once and swaps it in as the snapshot served on /metrics.
+
+        The body is compressed here too, so scrapers sending Accept-Encoding: gzip do not cost a compression each.
+        A failed cycle (collected=False) keeps the time and flag of the last successful collection,
+        so /healthz and /ready report how old the data is rather than whether the loop is running.
+        """
+        published, _, _, was_collected = self.snapshot
+        if collected:
+            published, was_collected = time.time(), True
+        body = generate_latest(self.registry)
+        self.snapshot = (published, body, gzip.compress(body, compresslevel=6), was_collected)
+
+    def route_request(self, target, interval, accepts_gzip=False):
+        """Returns (status, content type, body, content encoding) for a GET on target, served from the current snapshot"""
+        url = urlparse(target)
+        published, body, gzipped, collected = self.snapshot
+        age = time.time() - published
+
+        if url.path in ('/', '/metrics'):
+            if accepts_gzip:
+                return 200, CONTENT_TYPE_LATEST, gzipped, 'gzip'
+            return 200, CONTENT_TYPE_LATEST, body, None
+        if url.path == '/history':
+            try:
+                return self.render_history(parse_qs(url.query)) + (None,)
+            except ValueError as e:
+                return 400, 'application/json', json.dumps({'error': str(e)}).encode(), None
+        if url.path in ('/healthz', '/ready'):
+            # Live while collections keep succeeding, ready once a fresh collection is being served
+            if url.path == '/healthz':
+                ok = age <= STALE_INTERVALS * interval
+            else:
+                ok = collected and age <= READY_INTERVALS * interval
+            status = {'status': 'ok' if ok else 'stale', 'collected': collected, 'snapshot_age_seconds': round(age, 3)}
+            return (200 if ok else 503), 'application/json', json.dumps(status).encode(), None
+        return 404, 'text/plain; charset=utf-8', b'Not Found\n', None
+
+    async def handle_request(self, reader, writer, interval):
+        """Minimal HTTP/1.1 handler, one GET per connection"""
+        import asyncio
+
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            accepts_gzip = False
+            while True:
+                header = await asyncio.wait_for(reader.readline(), timeout=10)
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                if name.strip().lower() == 'accept-encoding':
+                    accepts_gzip = accepts_gzip or gzip_accepted(value)
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3:
+                return
+            if parts[0] not in ('GET', 'HEAD'):
+                status, content_type, body, encoding = 405, 'text/plain; charset=utf-8', b'Method Not Allowed\n', None
+            else:
+                status, content_type, body, encoding = self.route_request(parts[1], interval, accepts_gzip)
+
+            encoding_header = f'Content-Encoding: {encoding}\r\nVary: Accept-Encoding\r\n' if encoding else ''
+            writer.write((f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                          f'Content-Type: {content_type}\r\n'
+                          f'Content-Length: {len(body)}\r\n'
+                          f'{encoding_header}'
+                          'Connection: close\r\n\r\n').encode('latin-1'))
+            if parts[0] == 'GET':
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_exporter(self, port, interval, collect, once=False):
+        """Serves /metrics, /history, /healthz and /ready while collect() runs in a worker thread every interval"""
+        # Only the long-running exporters pay for asyncio, --textfile and replay runs never load it
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.publish_snapshot(collected=False)
+        server = await asyncio.start_server(lambda r, w: self.handle_request(r, w, interval), port=port)
+
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='collector') as executor:
+            async with server:
+                while True:
+                    logger.debug('collecting metrics')
+                    await loop.run_in_executor(executor, collect)
+                    if once:
+                        return
+                    await asyncio.sleep(interval)
+
+def record_output(record_dir, kind, timestamp, data):
+    """Saves one raw source output, gzip compressed, as <kind>-<epoch ms>.gz in record_dir"""
+    path = os.path.join(record_dir, f'{kind}-{int(timestamp * 1000)}.gz')
+    try:
+        with gzip.open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+    except OSError as e:
+        logger.warning('Failed to record %s output to %s: %s', kind, path, e)
+
+def load_recordings(replay_dir, kind):
+    """Yields (timestamp, raw output) for the <kind> recordings in replay_dir, oldest first"""
+    recordings = []
+    for path in glob.glob(os.path.join(replay_dir, f'{kind}-*.gz')):
+        epoch_ms = os.path.basename(path)[len(kind) + 1:-len('.gz')]
+        if epoch_ms.isdigit():
+            recordings.append((int(epoch_ms), path))
+
+    for epoch_ms, path in sorted(recordings):
+        with gzip.open(path, 'rb') as f:
+            yield epoch_ms / 1000, f.read()
+
+def replay_recordings(replay_dir, kind, realtime, collect):
+    """Feeds each recording through collect(timestamp, raw output), as fast as possible or at the recorded pace"""
+    count = 0
+    previous = None
+    started = time.perf_counter()
+    for timestamp, data in load_recordings(replay_dir, kind):
+        if realtime and previous is not None:
+            time.sleep(max(0.0, timestamp - previous))
+        previous = timestamp
+        collect(timestamp, data)
+        count += 1
+
+    elapsed = time.perf_counter() - started
+    logger.info('replayed kind=%s recordings=%d dir=%s seconds=%.3f ms_per_cycle=%.2f',
+                kind, count, replay_dir, elapsed, elapsed / count * 1000 if count else 0.0)